@@ -1,38 +1,115 @@
 import os
-import requests
-from flask import Flask, request, jsonify, render_template
+import contextlib
+import functools
+import hashlib
+import queue
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import faiss
+import httpx
+import numpy as np
+import orjson
+from flask import Flask, request, jsonify, make_response, render_template
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
+from celery import Celery
+from celery.result import AsyncResult
 from dotenv import load_dotenv
-from supermemory import Supermemory
+from fastembed import TextEmbedding
+from supermemory import APITimeoutError, Supermemory
 
 # This line loads the API keys from your .env file
 load_dotenv()
 
 # --- Configuration ---
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Routes Flask's JSON encoding and decoding through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+app.config["COMPRESS_MIN_SIZE"] = 512
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+Compress(app)
 
 # Securely load API keys from the environment
 SUPERMEMORY_API_KEY = os.getenv("SUPERMEMORY_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Uploads are spooled here for ingestion; must be visible to the Celery workers.
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "kb-uploads"))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Size of the thread pools that run upstream calls for /query. Each server
+# thread can have one search and one Gemini call in flight, so keep this in
+# line with threads in gunicorn.conf.py.
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", "32"))
+
+# Document ingestion runs in a Celery worker so /upload returns immediately.
+# Start one with: celery -A app.celery worker
+celery = Celery("kb", broker=REDIS_URL, backend=REDIS_URL)
+
 
+# The API key is sent in the x-goog-api-key header rather than the URL so it
+# never shows up in logged request lines or error messages.
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+# Partial response: only the answer text is read, so ask Gemini to omit the rest
+GEMINI_RESPONSE_FIELDS = "candidates(content(parts(text)))"
+
+# Fail fast on hung upstreams instead of tying up a worker thread indefinitely.
+# The limits apply to each connect (3.05s) and to each socket read/write
+# (30s), not to a whole response, so a slowly trickling reply can take longer.
+# Retries live only in the shared transport (2 connect retries), so one call
+# that goes quiet times out after about 40s (3 connect attempts plus backoff,
+# then a 30s stalled read). /query makes the Supermemory search and the Gemini
+# call one after the other, and a Gemini reply that cannot be split out of a
+# batch adds another Gemini call, so /query can take 80-120s before its 504.
+UPSTREAM_TIMEOUT = httpx.Timeout(30.0, connect=3.05)
+
+# One pooled client for all outbound HTTP calls so connections (and TLS
+# handshakes) are reused across requests instead of reopened every time.
+# HTTP/2 lets concurrent calls to the same host share a single connection.
+http_client = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    ),
+    headers={
+        "Accept-Encoding": "gzip",
+        "User-Agent": "supermemory-kb/1.0 (gzip)",
+    },
+    timeout=UPSTREAM_TIMEOUT,
+)
 
 try:
-    supermemory_client = Supermemory(api_key=SUPERMEMORY_API_KEY)
+    # Share the pooled client so SDK calls reuse the same connections. Its
+    # transport already retries connects, so the SDK must not retry on top.
+    supermemory_client = Supermemory(
+        api_key=SUPERMEMORY_API_KEY,
+        http_client=http_client,
+        timeout=UPSTREAM_TIMEOUT,
+        max_retries=0,
+    )
 except Exception as e:
     print(f"Error initializing Supermemory client: {e}")
     supermemory_client = None
 
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
-
 
 # --- API Client Functions ---
 
-def upload_document_to_supermemory(file):
-    filename = file.filename
+def upload_document_to_supermemory(filename, file_content):
     print(f"Uploading '{filename}' as a Document object via the SDK...")
     
-    # Read the file content into bytes
-    file_content = file.read()
-    
     result = supermemory_client.memories.upload_file(
         file=(filename, file_content),
         container_tags=[filename]
@@ -41,6 +118,17 @@ def upload_document_to_supermemory(file):
     print(f"Successfully submitted Document for processing. Response: {result}")
     return result
 
+@celery.task
+def ingest(filename, path):
+    # The SDK streams the open file into the multipart body in chunks, so the
+    # document is never held in memory as a whole.
+    try:
+        with open(path, "rb") as file_content:
+            result = upload_document_to_supermemory(filename, file_content)
+    finally:
+        os.remove(path)
+    return getattr(result, "id", None)
+
 def search_with_supermemory(query):
     print(f"Searching Supermemory documents (v3) via SDK for: '{query}'")
     
@@ -57,11 +145,8 @@ def search_with_supermemory(query):
     return results
 
 
-def generate_cohesive_answer(question, context, source):
-    print("Sending retrieved context to Gemini for answer generation...")
-    headers = {"Content-Type": "application/json"}
-    
-    prompt = f"""
+# Built once at import; filled in with str.format for each question.
+_PROMPT_TEMPLATE = """
     You are an expert assistant. Your task is to answer the user's question based *only* on the following context retrieved from the document named '{source}'.
     Do not use any outside knowledge. If the answer is not in the context, state that clearly.
 
@@ -74,23 +159,340 @@ def generate_cohesive_answer(question, context, source):
 
     **Answer:**
     """
+
+def generate_cohesive_answer(question, context, source):
+    prompt = _PROMPT_TEMPLATE.format(source=source, context=context, question=question)
+    return generate_answer_for_prompt(prompt)
+
+# The rendered prompt is the cache key, so identical questions over the same
+# context are answered from memory instead of another Gemini round-trip.
+@functools.lru_cache(maxsize=2048)
+def generate_answer_for_prompt(prompt):
+    return request_gemini_answer(prompt)
+
+def request_gemini_answer(prompt):
+    print("Sending retrieved context to Gemini for answer generation...")
     
-    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    payload = {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": {"candidateCount": 1, "responseMimeType": "text/plain"},
+    }
     
-    response = requests.post(GEMINI_API_URL, json=payload, headers=headers)
+    response = http_client.post(
+        GEMINI_API_URL,
+        params={"fields": GEMINI_RESPONSE_FIELDS},
+        headers={"x-goog-api-key": GEMINI_API_KEY},
+        json=payload,
+    )
     response.raise_for_status()
     
-    result = response.json()
+    result = orjson.loads(response.content)
     print("Received generated answer from Gemini.")
     return result['candidates'][0]['content']['parts'][0]['text']
 
+# Several questions sent to Gemini in one call. Each question carries its own
+# context, and the answers come back under numbered markers so they can be split.
+_BATCH_PROMPT_TEMPLATE = """
+    You are an expert assistant. Your task is to answer each of the numbered questions below based *only* on the context given with that question.
+    Do not use any outside knowledge. If an answer is not in its context, state that clearly.
+    Begin each answer with a line containing only "### Answer N", where N is the question's number, and write nothing before the first answer.
+{questions}
+    """
+
+_BATCH_QUESTION_TEMPLATE = """
+    **Question {number}** (context retrieved from the document named '{source}'):
+    ---
+    {context}
+    ---
+
+    **User's Question:** {question}
+"""
+
+# A marker must be a whole "### Answer N" line; anything else is answer text.
+_BATCH_ANSWER_MARKER = re.compile(r"^[ \t]*#{1,6}[ \t]*Answer[ \t]+(\d+)[ \t]*:?[ \t]*$", re.MULTILINE)
+
+def split_batched_answers(text, count):
+    """Maps a batched Gemini reply back to its questions by marker number.
+
+    Returns the answers in question order, or None unless questions 1..count
+    are each answered exactly once.
+    """
+    parts = _BATCH_ANSWER_MARKER.split(text)
+    numbers = [int(number) for number in parts[1::2]]
+    if sorted(numbers) != list(range(1, count + 1)):
+        return None
+    answers = dict(zip(numbers, (answer.strip() for answer in parts[2::2])))
+    return [answers[number] for number in range(1, count + 1)]
+
+def generate_batched_answers(items):
+    questions = "".join(
+        _BATCH_QUESTION_TEMPLATE.format(number=number, source=source, context=context, question=question)
+        for number, (question, context, source) in enumerate(items, start=1)
+    )
+    # Not cached: a prompt combining several users' questions will not repeat
+    text = request_gemini_answer(_BATCH_PROMPT_TEMPLATE.format(questions=questions))
+    return split_batched_answers(text, len(items))
+
+class GeminiBatcher:
+    """Collects questions that arrive within a short window and answers them
+    with a single Gemini call instead of one round-trip per question."""
+
+    def __init__(self, window=0.02, max_size=8, workers=QUERY_WORKERS):
+        self.window = window
+        self.max_size = max_size
+        self._queue = queue.Queue()
+        # Every Gemini call runs here, so the pool must not cap them below
+        # the number of request threads.
+        self._flush_pool = ThreadPoolExecutor(max_workers=workers)
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, question, context, source):
+        future = Future()
+        self._ensure_worker()
+        self._queue.put(((question, context, source), future))
+        return future
+
+    def _ensure_worker(self):
+        # Started on first use so the Celery worker, which never answers
+        # questions, does not run the collector thread.
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._collect, daemon=True)
+                    self._worker.start()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Flush on another thread so the next batch is collected while
+            # this one waits on Gemini.
+            self._flush_pool.submit(self._flush, batch)
+
+    def _flush(self, batch):
+        if len(batch) > 1:
+            try:
+                answers = generate_batched_answers([item for item, _ in batch])
+            except Exception as e:
+                # A failing upstream (timeout, 429, 5xx) would fail the
+                # individual calls too, so report it rather than multiply it.
+                for _, future in batch:
+                    future.set_exception(e)
+                return
+            if answers is not None:
+                for (_, future), answer in zip(batch, answers):
+                    future.set_result(answer)
+                return
+            # The reply could not be split, so each question is asked on its
+            # own, in parallel.
+            print("Could not split batched Gemini answer; answering questions individually.")
+            for item, future in batch[1:]:
+                self._flush_pool.submit(self._answer_one, item, future)
+        self._answer_one(*batch[0])
+
+    def _answer_one(self, item, future):
+        try:
+            future.set_result(generate_cohesive_answer(*item))
+        except Exception as e:
+            future.set_exception(e)
+
+gemini_batcher = GeminiBatcher()
+
+# --- Semantic Answer Cache ---
+
+class SemanticCache:
+    """Caches answers by question embedding so paraphrased repeats of a
+    question are answered without calling Supermemory or Gemini again."""
+
+    def __init__(self, model_name, threshold=0.85, ttl=300, max_size=1000):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self._model = None
+        self._index = None
+        self._entries = OrderedDict()  # entry id -> (answer, timestamp), LRU order
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def start_loading(self):
+        # Called at server startup rather than on import, so the Celery
+        # worker never loads the model. Loading runs in the background so a
+        # slow model download does not hold up the server.
+        threading.Thread(target=self._load_model, daemon=True).start()
+
+    def _load_model(self):
+        try:
+            self._model = TextEmbedding(model_name=self.model_name)
+        except Exception as e:
+            print(f"Semantic cache disabled, could not load embedding model: {e}")
+
+    def embed(self, text):
+        # None until the model has loaded; callers treat that as a cache miss
+        if self._model is None:
+            return None
+        vector = np.asarray(next(iter(self._model.embed([text]))), dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, embedding):
+        with self._lock:
+            if not self._entries:
+                return None
+            scores, ids = self._index.search(embedding, 1)
+            entry_id = int(ids[0][0])
+            if entry_id == -1 or scores[0][0] < self.threshold:
+                return None
+            answer, timestamp = self._entries[entry_id]
+            if time.time() - timestamp >= self.ttl:
+                self._remove(entry_id)
+                return None
+            self._entries.move_to_end(entry_id)
+            return answer
+
+    def add(self, embedding, answer):
+        with self._lock:
+            if self._index is None:
+                self._index = faiss.IndexIDMap(faiss.IndexFlatIP(embedding.shape[1]))
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(embedding, np.array([entry_id], dtype="int64"))
+            self._entries[entry_id] = (answer, time.time())
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id):
+        del self._entries[entry_id]
+        self._index.remove_ids(np.array([entry_id], dtype="int64"))
+
+semantic_cache = SemanticCache("sentence-transformers/all-MiniLM-L6-v2")
+
+# The cache is only a speed-up, so any failure in it counts as a miss and
+# the question is answered normally.
+def probe_semantic_cache(question):
+    try:
+        embedding = semantic_cache.embed(question)
+        if embedding is None:
+            return None, None
+        return embedding, semantic_cache.lookup(embedding)
+    except Exception as e:
+        print(f"Semantic cache lookup failed: {e}")
+        return None, None
+
+def store_in_semantic_cache(embedding, answer):
+    if embedding is None:
+        return
+    try:
+        semantic_cache.add(embedding, answer)
+    except Exception as e:
+        print(f"Semantic cache store failed: {e}")
+
+# --- Query Pipeline ---
+
+# How many chunks of the top search hit are passed to Gemini as context
+MAX_CONTEXT_CHUNKS = 3
+
+# Runs Supermemory searches in the background while the request thread probes
+# the cache.
+executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+# Questions currently being answered, so concurrent duplicates can wait on
+# the first caller's result instead of repeating the upstream calls.
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def single_flight(key, fn, *args):
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _inflight[key] = future
+
+    if is_leader:
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with _inflight_lock:
+                del _inflight[key]
+    return future.result()
+
+def answer_question(question):
+    # Probe the cache while the search is already in flight, so a miss
+    # does not add the embedding time to the search latency.
+    search_future = executor.submit(search_with_supermemory, question)
+
+    # Serve near-duplicate questions straight from the cache
+    question_embedding, cached_answer = probe_semantic_cache(question)
+    if cached_answer is not None:
+        search_future.cancel()
+        return cached_answer
+
+    # search_results is a SearchDocumentsResponse
+    search_results = search_future.result()
+
+    # Extract the actual list of hits
+    results_list = search_results.results or []
+
+    # Results are ranked, so answer from the best hit that has chunks and give
+    # Gemini its top few chunks rather than just one.
+    for i, result in enumerate(results_list):
+        chunks = getattr(result, "chunks", [])
+        if chunks:
+            source = getattr(result, "title", f"Source {i+1}")
+            context = "\n---\n".join(
+                getattr(chunk, "content", "") for chunk in chunks[:MAX_CONTEXT_CHUNKS]
+            )
+            break
+    else:
+        # Handle case: no results or no chunks
+        return "I'm sorry, I couldn't find any information in your documents related to that question."
+
+    final_answer = gemini_batcher.submit(question, context, source).result()
+    store_in_semantic_cache(question_embedding, final_answer)
+    return final_answer
+
 # --- Flask Web Routes ---
 
+# The page has no per-request state, so it is rendered and hashed only once
+@functools.lru_cache(maxsize=1)
+def render_index_page():
+    html = render_template('index.html')
+    return html, hashlib.sha1(html.encode("utf-8")).hexdigest()
+
 @app.route('/')
 def index():
     if not supermemory_client or not GEMINI_API_KEY:
         return "<h1>Configuration Error: Client failed to initialize. Please check your API keys.</h1>", 500
-    return render_template('index.html')
+    if app.debug:
+        # Pick up template edits while developing
+        render_index_page.cache_clear()
+    html, etag = render_index_page()
+
+    # flask-compress tags compressed responses as "<etag>:<algorithm>", so
+    # browsers echo the suffixed tag. Answering 304 here for any of those
+    # avoids compressing the whole page again just to revalidate it.
+    for tag in [etag] + [f"{etag}:{algorithm}" for algorithm in app.config["COMPRESS_ALGORITHM"]]:
+        if request.if_none_match.contains(tag):
+            response = make_response("", 304)
+            response.set_etag(tag)
+            break
+    else:
+        response = make_response(html)
+        response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, max-age=300, must-revalidate"
+    return response
 
 @app.route('/upload', methods=['POST'])
 def upload_file_route():
@@ -98,12 +500,33 @@ def upload_file_route():
     if not file or file.filename == '':
         return jsonify({"success": False, "error": "No file selected"}), 400
     
+    spooled_path = None
     try:
-        upload_document_to_supermemory(file)
-        return jsonify({"success": True, "message": f"'{file.filename}' was successfully sent to Supermemory."})
+        # Copy the upload to disk in 64KB chunks rather than reading it into memory
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, delete=False) as spooled:
+            spooled_path = spooled.name
+            file.save(spooled, buffer_size=UPLOAD_CHUNK_SIZE)
+        task = ingest.delay(file.filename, spooled_path)
+        return jsonify({
+            "success": True,
+            "task_id": task.id,
+            "message": f"'{file.filename}' was queued for processing."
+        }), 202
     except Exception as e:
+        # The task never received the file, so nothing else will remove it
+        if spooled_path:
+            with contextlib.suppress(OSError):
+                os.remove(spooled_path)
         return jsonify({"success": False, "error": f"An error occurred: {str(e)}"}), 500
 
+@app.route('/status/<task_id>')
+def upload_status_route(task_id):
+    result = AsyncResult(task_id, app=celery)
+    if result.failed():
+        return jsonify({"state": result.state, "error": str(result.result)})
+    return jsonify({"state": result.state})
+
 @app.route('/query', methods=['POST'])
 def query_route():
     question = request.get_json().get('question')
@@ -111,29 +534,19 @@ def query_route():
         return jsonify({"error": "Question is required."}), 400
 
     try:
-    # search_results is a SearchDocumentsResponse
-        search_results = search_with_supermemory(question)
-
-        # Extract the actual list of hits
-        results_list = search_results.results
-
-        # Handle case: no results or no chunks
-        if not results_list or not getattr(results_list[0], "chunks", []):
-            return jsonify({
-                "answer": "I'm sorry, I couldn't find any information in your documents related to that question."
-            })
-
-
-        for i, result in enumerate(results_list):
-            chunks = getattr(result, "chunks", [])
-            if chunks:
-                source = getattr(result, "title", f"Source {i+1}")
-                context = getattr(chunks[0], "content", "")
-
-        final_answer = generate_cohesive_answer(question, context, source)
+        # Identical questions arriving together share one upstream round-trip
+        final_answer = single_flight(question, answer_question, question)
         return jsonify({"answer": final_answer})
+    except (httpx.TimeoutException, APITimeoutError):
+        return jsonify({"error": "The request timed out. Please try again."}), 504
     except Exception as e:
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
+# Development server only. In production run many concurrent upstream calls
+# per process with: gunicorn app:app (settings in gunicorn.conf.py; keep
+# QUERY_WORKERS equal to its threads).
 if __name__ == '__main__':
+    # With the debug reloader, only the child process serves requests
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        semantic_cache.start_loading()
     app.run(debug=True, port=5001)
\ No newline at end of file
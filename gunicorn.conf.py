@@ -0,0 +1,11 @@
+# Gunicorn settings, read automatically by: gunicorn app:app
+# Keep QUERY_WORKERS (see app.py) equal to threads.
+workers = 4
+worker_class = "gthread"
+threads = 32
+
+
+def post_worker_init(worker):
+    # Load the embedding model as each worker starts, not on its first query
+    from app import semantic_cache
+    semantic_cache.start_loading()
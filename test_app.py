@@ -0,0 +1,41 @@
+from app import split_batched_answers
+
+
+def test_split_in_order():
+    text = "### Answer 1\nParis.\n\n### Answer 2\nBlue.\n"
+    assert split_batched_answers(text, 2) == ["Paris.", "Blue."]
+
+
+def test_split_swapped_markers_follow_numbers():
+    text = "### Answer 2\nBlue.\n### Answer 1\nParis."
+    assert split_batched_answers(text, 2) == ["Paris.", "Blue."]
+
+
+def test_split_duplicated_marker_is_rejected():
+    text = "### Answer 1\nParis.\n### Answer 1\nBlue."
+    assert split_batched_answers(text, 2) is None
+
+
+def test_split_missing_marker_is_rejected():
+    text = "### Answer 1\nParis.\nBlue."
+    assert split_batched_answers(text, 2) is None
+
+
+def test_split_out_of_range_marker_is_rejected():
+    text = "### Answer 1\nParis.\n### Answer 3\nBlue."
+    assert split_batched_answers(text, 2) is None
+
+
+def test_split_bold_and_inline_markers_are_not_markers():
+    assert split_batched_answers("**Answer 1**\nParis.\n**Answer 2**\nBlue.", 2) is None
+    assert split_batched_answers("### Answer 1: Paris.\n### Answer 2: Blue.", 2) is None
+
+
+def test_split_plain_answer_line_in_body_stays_in_answer():
+    text = "### Answer 1\nSee step\nAnswer 3\nbelow.\n### Answer 2\nBlue."
+    assert split_batched_answers(text, 2) == ["See step\nAnswer 3\nbelow.", "Blue."]
+
+
+def test_split_ignores_preamble_before_first_marker():
+    text = "Here are the answers.\n### Answer 1\nParis.\n### Answer 2\nBlue."
+    assert split_batched_answers(text, 2) == ["Paris.", "Blue."]